@@ -0,0 +1,69 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Optional C fast path for the voice relay (Linux/POSIX only).
+
+relay() sends one audio chunk to every socket in a list of file descriptors
+with the GIL released, so the server's Python thread isn't stuck in the
+interpreter for the whole fan-out.
+
+Build in place next to server.py with:
+    pip install cython
+    cythonize -i audio_relay.pyx
+
+server.py falls back to its pure-Python broadcast when this isn't built.
+"""
+
+from libc.errno cimport errno, EAGAIN, EINTR
+from libc.stdlib cimport malloc, free
+
+cdef extern from "<errno.h>":
+    int EWOULDBLOCK
+
+cdef extern from "<sys/socket.h>" nogil:
+    ssize_t send(int sockfd, const void *buf, size_t length, int flags)
+    int MSG_DONTWAIT
+    int MSG_NOSIGNAL
+
+
+def relay(int[:] fds, const unsigned char[:] data, int skip_fd=-1):
+    """
+    Non-blocking send of data to each fd (except skip_fd).
+    Returns a list with one entry per fd: bytes written (less than len(data)
+    on a short write, 0 if the socket buffer was full or the fd was skipped),
+    or -1 if the socket is dead.
+    """
+    cdef Py_ssize_t i
+    cdef Py_ssize_t nfds = fds.shape[0]
+    cdef size_t length = data.shape[0]
+    cdef const unsigned char *buf
+    cdef ssize_t n
+    cdef ssize_t *sent
+
+    if nfds == 0:
+        return []
+    if length == 0:
+        return [0] * nfds
+    buf = &data[0]
+    sent = <ssize_t *> malloc(nfds * sizeof(ssize_t))
+    if sent == NULL:
+        raise MemoryError()
+    try:
+        with nogil:
+            for i in range(nfds):
+                if fds[i] == skip_fd:
+                    sent[i] = 0
+                    continue
+                while True:
+                    n = send(fds[i], buf, length, MSG_DONTWAIT | MSG_NOSIGNAL)
+                    if n < 0 and errno == EINTR:
+                        continue
+                    break
+                if n >= 0:
+                    sent[i] = n
+                elif errno == EAGAIN or errno == EWOULDBLOCK:
+                    sent[i] = 0
+                else:
+                    sent[i] = -1
+        return [sent[i] for i in range(nfds)]
+    finally:
+        free(sent)
@@ -10,387 +10,889 @@ Operator commands:
 - reject <pid>      : reject pending request
 - list              : show connected clients (id, name, ip)
 - kick <id>         : disconnect a connected client by user id
+- stats             : show each client's send queue and dropped audio frames
 - broadcast <msg>   : send a server message to all clients
 - stop              : shutdown server
 """
 
+import os
+import queue
+import selectors
 import socket
+import struct
 import threading
 import time
 import sys
+from array import array
+from collections import deque
+from dataclasses import dataclass, field
+
+# Optional C fan-out for voice relays (see audio_relay.pyx); pure Python otherwise
+try:
+    import audio_relay
+except ImportError:
+    audio_relay = None
 
 HOST = '0.0.0.0'
 PORT = 50007
 
 # Audio defaults (used only in voice mode)
-CHUNK = 2048
+CHUNK = 1920  # 40 ms at 48 kHz; clients Opus-encode each chunk
 RATE = 48000
 CHANNELS = 1
+SAMPLE_WIDTH = 2  # paInt16
+
+# recv sizes: text messages are short; a voice read is capped at one raw PCM chunk,
+# which holds many Opus frames
+MSG_RECV = 4096
+AUDIO_RECV = CHUNK * CHANNELS * SAMPLE_WIDTH
+
+# After the handshake every message in either direction is a frame:
+# 1-byte type + 2-byte big-endian length + payload.
+# Audio payloads are opaque Opus packets; the server relays audio frames unchanged.
+HDR = struct.Struct('!BH')
+AUDIO_FRAME = 0
+TEXT_FRAME = 1
+MAX_FRAME = 0xFFFF
+
+# Voice sockets: bigger kernel buffers absorb broadcast bursts
+SOCK_BUF = 262144
+# TCP keepalive: probe after 30 s idle, every 10 s, give up after 3 misses,
+# so a vanished peer is dropped in about a minute instead of the OS default 2 h
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTVL = 10
+KEEPALIVE_CNT = 3
+# Queued audio frames per peer (40 ms each). Voice tolerates loss but not latency:
+# once a slow peer has this many waiting, the oldest relays are dropped for the newest.
+AUDIO_QUEUE_MAX = 4
+# Bytes queued per peer, of any kind. A client that stops reading altogether
+# (e.g. a stalled chat client the kernel still ACKs for) is disconnected past this.
+OUTBUF_LIMIT = 262144
+# Audio frames relayed per broadcast. 2 halves the relay's send() calls when the
+# reactor falls behind, at the cost of holding a chunk back for up to AUDIO_BATCH_WAIT.
+AUDIO_BATCH = 1
+AUDIO_BATCH_WAIT = 0.02  # seconds
+# A new connection must send its NAME line within this long or it is closed
+HANDSHAKE_TIMEOUT = 5.0  # seconds
+# Open connections in any state; more are refused at accept so a flood can't exhaust fds/memory
+MAX_CONNECTIONS = 64
 
 # runtime mode: set at server start
 MODE = None  # "MESSAGING" or "VOICE"
+_MODE_BYTES = b""  # acceptance line for MODE, encoded once in main()
 
 server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 server_sock.bind((HOST, PORT))
 server_sock.listen(50)
+server_sock.setblocking(False)
+
+# Single I/O thread multiplexes every socket (epoll on Linux)
+sel = selectors.DefaultSelector()
+
+# The stdin fallback thread writes a byte here to wake the reactor out of select()
+wakeup_r, wakeup_w = socket.socketpair()
+wakeup_r.setblocking(False)
+
+# Connection states
+HANDSHAKE = "HANDSHAKE"  # waiting for the NAME line
+PENDING = "PENDING"      # waiting for operator accept/reject
+ACCEPTED = "ACCEPTED"    # relaying text/audio
+
+@dataclass(slots=True)
+class ClientInfo:
+    """Per-connection state, from the NAME handshake until disconnect."""
+    addr: tuple
+    buf: bytearray                   # receive buffer reused by every recv_into
+    mv: memoryview = field(init=False)
+    state: str = HANDSHAKE
+    id: int = 0
+    name: str = ""
+    pid: int = 0
+    inbuf: bytearray = field(default_factory=bytearray)    # partial NAME line / voice frame
+    outbuf: deque = field(default_factory=deque)   # (bytes, audio frames) the socket couldn't take yet
+    outbuf_bytes: int = 0                           # total length of outbuf
+    queued_frames: int = 0                          # droppable audio frames in outbuf
+    dropped_frames: int = 0
+    audio_batch: bytearray = field(default_factory=bytearray)
+    batch_frames: int = 0
+    batch_deadline: float = 0.0
+
+    def __post_init__(self):
+        self.mv = memoryview(self.buf)
 
 # Data structures
-clients_lock = threading.Lock()
-clients = {}         # conn -> {"id":int, "name":str, "addr":(ip,port)}
+conn_state = {}      # conn -> ClientInfo, for every open connection
+
+# Accepted clients as parallel arrays so broadcasts walk a plain list;
+# conn_index gives O(1) swap-pop removal.
+conns = []           # [conn]
+metas = []           # [ClientInfo], same order as conns
+conn_index = {}      # conn -> position in conns/metas
+# Rebuilt only when membership changes, so broadcasts iterate them without copying
+_clients_snapshot = ()  # tuple(conns)
+relay_fds = array('i')  # fileno() of each conn, same order
+_USERS_PREFIX = b"[USERS] "
+_users_bytes = bytearray(_USERS_PREFIX)  # voice user list sent on join: appended on join, rebuilt on leave
 next_user_id = 1
 
-pending_lock = threading.Lock()
-pending = {}         # pending_id -> {"conn":conn, "name":str, "addr":addr, "event":threading.Event(), "decision":None}
+pending = {}         # pending_id -> {"conn":conn, "name":str, "addr":addr}
 next_pending_id = 1
 
+# (deadline, conn) per connection still in HANDSHAKE. Every deadline is accept time plus
+# the same timeout, so they are pushed in order and a deque serves as the min-heap.
+handshake_deadlines = deque()
+
+batched_conns = set()  # senders holding a partial audio batch
+backlogged = set()     # conns with bytes waiting in outbuf
+
+# Operator input. Commands run on the reactor thread, so nothing here needs a lock.
+cli_buf = bytearray()     # partial command line read from stdin
+cli_lines = queue.Queue() # lines from the stdin thread where stdin can't be selected (Windows)
+
 running = True
 
+def _wake():
+    """Interrupt the reactor's select() so it picks up lines posted by the stdin thread."""
+    try:
+        wakeup_w.send(b"\0")
+    except OSError:
+        pass
+
+def _send(conn, data, frames=0):
+    """
+    Write bytes to a client without blocking.
+    Whatever the socket can't take right now is queued on its outbuf and
+    flushed when the selector reports it writable. frames > 0 marks relayed
+    audio holding that many frames, which may be discarded (oldest first)
+    once more than AUDIO_QUEUE_MAX frames are waiting. Returns False if the
+    connection is dead or has more than OUTBUF_LIMIT bytes queued; the
+    caller disconnects it.
+    """
+    st = conn_state.get(conn)
+    if st is None:
+        return False
+    if not st.outbuf:
+        try:
+            n = conn.send(data)
+        except BlockingIOError:
+            n = 0
+        except OSError:
+            return False
+        if n == len(data):
+            return True
+        if n:
+            # the peer already has the start of this, so the rest must go out
+            data = data[n:]
+            frames = 0
+    return _enqueue(conn, st, data, frames)
+
+def _enqueue(conn, st, data, frames=0):
+    """Internal: queue bytes on st.outbuf without trying the socket first. Same return as _send."""
+    q = st.outbuf
+    if frames:
+        _make_room(st, frames)
+    # copy: data is often a view into a reused receive buffer
+    q.append((bytes(data), frames))
+    st.outbuf_bytes += len(data)
+    st.queued_frames += frames
+    if len(q) == 1:
+        backlogged.add(conn)
+        try:
+            sel.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, _on_client_event)
+        except (KeyError, ValueError):
+            return False
+    return st.outbuf_bytes <= OUTBUF_LIMIT
+
+def _make_room(st, frames):
+    """Internal: drop the oldest queued audio until frames more fit within AUDIO_QUEUE_MAX."""
+    q = st.outbuf
+    i = 0
+    while st.queued_frames + frames > AUDIO_QUEUE_MAX and i < len(q):
+        data, n = q[i]
+        if not n:
+            i += 1
+            continue
+        del q[i]
+        st.outbuf_bytes -= len(data)
+        st.queued_frames -= n
+        st.dropped_frames += n
+
+def _flush(conn):
+    """Write-ready callback: drain the queued outbuf, stop watching for writes once empty."""
+    st = conn_state.get(conn)
+    if st is None:
+        return
+    q = st.outbuf
+    while q:
+        data, frames = q[0]
+        try:
+            n = conn.send(data)
+        except BlockingIOError:
+            return
+        except OSError:
+            _drop_conn(conn)
+            return
+        st.outbuf_bytes -= n
+        st.queued_frames -= frames
+        if n < len(data):
+            # partially sent: the remainder can no longer be dropped
+            q[0] = (memoryview(data)[n:], 0)
+            return
+        q.popleft()
+    backlogged.discard(conn)
+    sel.modify(conn, selectors.EVENT_READ, _on_client_event)
+
+def _try_send(conn, data):
+    """
+    Internal: best-effort notice to a connection that is about to be closed.
+    Queued bytes go first so the notice can't split a frame; a peer too
+    backed up to take it all now doesn't get it, instead of stalling the reactor.
+    """
+    st = conn_state.get(conn)
+    if st is not None and st.outbuf:
+        _flush(conn)
+        if st.outbuf:
+            return
+    try:
+        conn.send(data)
+    except OSError:
+        pass
+
+def _close(conn):
+    """Internal: unregister and close a socket, forgetting its state."""
+    conn_state.pop(conn, None)
+    batched_conns.discard(conn)
+    backlogged.discard(conn)
+    try:
+        sel.unregister(conn)
+    except (KeyError, ValueError):
+        pass
+    try:
+        conn.close()
+    except:
+        pass
+
+def _add_client(conn, info):
+    """Internal: append an accepted client."""
+    conn_index[conn] = len(conns)
+    conns.append(conn)
+    metas.append(info)
+    _rebuild_snapshot()
+    if MODE == "VOICE":
+        if len(metas) > 1:
+            _users_bytes.extend(b",")
+        _users_bytes.extend(f"{info.id}|{info.name}".encode())
+
+def _remove_client(conn):
+    """Internal: swap-pop a client out of conns/metas. Returns its ClientInfo or None."""
+    i = conn_index.pop(conn, None)
+    if i is None:
+        return None
+    info = metas[i]
+    last_conn = conns.pop()
+    last_meta = metas.pop()
+    if i < len(conns):
+        conns[i] = last_conn
+        metas[i] = last_meta
+        conn_index[last_conn] = i
+    _rebuild_snapshot()
+    if MODE == "VOICE":
+        _rebuild_users()
+    return info
+
+def _rebuild_snapshot():
+    """Internal: refresh the broadcast snapshot and the fd array handed to audio_relay."""
+    global _clients_snapshot, relay_fds
+    _clients_snapshot = tuple(conns)
+    if audio_relay is not None:
+        relay_fds = array('i', [c.fileno() for c in conns])
+
+def _rebuild_users():
+    """Internal: rewrite the cached [USERS] list from metas after someone leaves."""
+    del _users_bytes[len(_USERS_PREFIX):]
+    _users_bytes.extend(",".join(f"{u.id}|{u.name}" for u in metas).encode())
+
+def _send_to(peers, data, exclude_conn=None):
+    """Internal: send the same bytes to a snapshot of connections, dropping any that are dead."""
+    dead = []
+    for conn in peers:
+        if conn == exclude_conn:
+            continue
+        if not _send(conn, data):
+            dead.append(conn)
+    for conn in dead:
+        _disconnect_conn(conn)
+
+def _wire(text):
+    """Internal: encode a server text message (str or UTF-8 bytes) as a TEXT frame."""
+    if isinstance(text, str):
+        text = text.encode()
+    msg = text[:MAX_FRAME]
+    return HDR.pack(TEXT_FRAME, len(msg)) + msg
+
+# Fixed notices, framed once instead of on every use
+KICK_NOTICE = _wire("[Server]: You were kicked by admin.")
+SHUTDOWN_NOTICE = _wire("[Server]: Server shutting down.")
+
 def broadcast_message(text, exclude_conn=None):
-    """Send a UTF-8 text message to all connected clients (messaging mode or notifications)."""
-    msg = text.encode()
-    with clients_lock:
-        for conn in list(clients.keys()):
-            if conn == exclude_conn:
+    """
+    Send a text message to all connected clients (messaging mode or notifications).
+    It is framed once and the same bytes go to every peer.
+    """
+    _send_to(_clients_snapshot, _wire(text), exclude_conn)
+
+def broadcast_audio(data, frames, exclude_conn=None):
+    """
+    Send raw audio bytes (frames complete audio frames) to all connected clients except the sender.
+    Each peer gets one non-blocking send; a slow peer's backlog is queued,
+    keeping at most AUDIO_QUEUE_MAX frames and dropping the oldest.
+    """
+    peers = _clients_snapshot
+    dead = []
+    if audio_relay is not None:
+        # Peers with queued bytes must append behind them to keep their stream in
+        # order; everyone else is written straight from C without the GIL.
+        if backlogged:
+            queued = [c for c in peers if c in backlogged]
+            direct = [c for c in peers if c not in backlogged]
+            fds = array('i', [c.fileno() for c in direct])
+        else:
+            queued = ()
+            direct = peers
+            fds = relay_fds
+        skip = exclude_conn.fileno() if exclude_conn is not None else -1
+        for conn, n in zip(direct, audio_relay.relay(fds, data, skip)):
+            if conn == exclude_conn or n == len(data):
                 continue
-            try:
-                conn.sendall(msg)
-            except Exception:
-                _disconnect_conn(conn)
-
-def broadcast_audio(data, exclude_conn=None):
-    """Send raw audio bytes to all connected clients except the sender."""
-    with clients_lock:
-        for conn in list(clients.keys()):
-            if conn == exclude_conn:
+            if n < 0:
+                dead.append(conn)
                 continue
-            try:
-                conn.sendall(data)
-            except Exception:
-                _disconnect_conn(conn)
+            st = conn_state.get(conn)
+            # the socket just refused more, so queue the rest without another send()
+            if st is None or not _enqueue(conn, st, data[n:], frames if n == 0 else 0):
+                dead.append(conn)
+        peers = queued
+    for conn in peers:
+        if conn == exclude_conn:
+            continue
+        if not _send(conn, data, frames):
+            dead.append(conn)
+    for conn in dead:
+        _disconnect_conn(conn)
 
 def _disconnect_conn(conn):
     """Internal: remove and close a client connection if present."""
-    global clients
-    with clients_lock:
-        if conn in clients:
-            user = clients.pop(conn)
-            try:
-                conn.close()
-            except:
-                pass
-            print(f"[-] Removed: {user['name']} (ID:{user['id']}) {user['addr']}")
-            # notify others
-            broadcast_message(f"[Server]: {user['name']} (ID:{user['id']}) has left the session.")
-
-def handle_accepted_client(conn, addr, user_id, name):
+    user = _remove_client(conn)
+    if not user:
+        return
+    peers = _clients_snapshot
+    _close(conn)
+    print(f"[-] Removed: {user.name} (ID:{user.id}) {user.addr}")
+    # notify others
+    _send_to(peers, _wire(f"[Server]: {user.name} (ID:{user.id}) has left the session."))
+
+def _drop_conn(conn):
+    """Internal: tear down a connection in whatever state it is in."""
+    st = conn_state.get(conn)
+    if st is None:
+        return
+    if st.state == ACCEPTED:
+        _disconnect_conn(conn)
+        return
+    if st.state == PENDING:
+        pending.pop(st.pid, None)
+        print(f"[PENDING {st.pid}] {st.name} from {st.addr} went away.")
+    _close(conn)
+
+def _reject(conn):
+    """Internal: tell a connection it was rejected and close it."""
+    _try_send(conn, b"REJECT\n")
+    _close(conn)
+
+def _set_opt(conn, level, name, value):
     """
-    For accepted clients:
-    - In MESSAGING mode: receive text messages and broadcast them (prefixed by name)
-    - In VOICE mode: receive audio chunks and broadcast to others. Also server sends join/leave notifications.
+    Internal: set socket option socket.<name> where the platform has it.
+    Tuning is best-effort: an OS or an already-reset peer that refuses the
+    option must not take the reactor down with it.
     """
+    opt = getattr(socket, name, None)
+    if opt is None:
+        return
     try:
-        if MODE == "VOICE":
-            # Send the current list of users so client can show already-joined participants
-            with clients_lock:
-                users = [f"{u['id']}|{u['name']}" for u in clients.values()]
-            users_msg = "[USERS] " + ",".join(users)
-            try:
-                conn.sendall(users_msg.encode())
-            except:
-                pass
-            broadcast_message(f"[Server]: {name} (ID:{user_id}) joined the call.", exclude_conn=conn)
-            # Now loop and relay audio bytes
-            while running:
-                try:
-                    data = conn.recv(CHUNK)
-                    if not data:
-                        break
-                    # detect textual leave command if it's short and decodable
-                    if len(data) < 64:
-                        try:
-                            text = data.decode(errors='ignore').strip()
-                            if text.lower() == "leave":
-                                break
-                        except:
-                            pass
-                    # broadcast raw audio to others
-                    broadcast_audio(data, exclude_conn=conn)
-                except ConnectionResetError:
-                    break
-                except Exception:
-                    break
-
-        else:  # MESSAGING
-            broadcast_message(f"[Server] User joined -> ID:{user_id}, Name:{name}", exclude_conn=conn)
-            # Send personal confirmation
-            try:
-                conn.sendall(f"Welcome {name}! Your ID is {user_id}".encode())
-            except:
-                pass
-
-            while running:
-                try:
-                    data = conn.recv(4096)
-                    if not data:
-                        break
-                    message = data.decode(errors='ignore').strip()
-                    if not message:
-                        continue
-                    if message.lower() == "leave":
-                        break
-                    full_msg = f"{name}: {message}"
-                    print(full_msg)
-                    broadcast_message(full_msg, exclude_conn=conn)
-                except ConnectionResetError:
-                    break
-                except Exception:
-                    break
-
-    finally:
-        # Remove client and notify
-        _disconnect_conn(conn)
+        conn.setsockopt(level, opt, value)
+    except OSError:
+        pass
 
-def handle_new_connection(conn, addr):
+def _on_accept(sock, mask):
+    """Listening socket is readable: take the new connection and wait for its NAME line."""
+    try:
+        conn, addr = sock.accept()
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        return
+    conn.setblocking(False)
+    if len(conn_state) >= MAX_CONNECTIONS:
+        print(f"[FULL] Refused {addr}: {MAX_CONNECTIONS} connections already open.")
+        _try_send(conn, b"REJECT\n")
+        conn.close()
+        return
+    _set_opt(conn, socket.SOL_SOCKET, "SO_KEEPALIVE", 1)
+    _set_opt(conn, socket.IPPROTO_TCP, "TCP_KEEPIDLE", KEEPALIVE_IDLE)
+    _set_opt(conn, socket.IPPROTO_TCP, "TCP_KEEPINTVL", KEEPALIVE_INTVL)
+    _set_opt(conn, socket.IPPROTO_TCP, "TCP_KEEPCNT", KEEPALIVE_CNT)
+    if MODE == "VOICE":
+        # audio chunks are small and latency sensitive: no Nagle coalescing
+        _set_opt(conn, socket.IPPROTO_TCP, "TCP_NODELAY", 1)
+        _set_opt(conn, socket.SOL_SOCKET, "SO_SNDBUF", SOCK_BUF)
+        _set_opt(conn, socket.SOL_SOCKET, "SO_RCVBUF", SOCK_BUF)
+    # one receive buffer per connection, reused by every recv_into
+    buf = bytearray(AUDIO_RECV if MODE == "VOICE" else MSG_RECV)
+    conn_state[conn] = ClientInfo(addr=addr, buf=buf)
+    sel.register(conn, selectors.EVENT_READ, _on_client_event)
+    handshake_deadlines.append((time.monotonic() + HANDSHAKE_TIMEOUT, conn))
+
+def _on_client_event(conn, mask):
+    """Selector callback for every client socket."""
+    if mask & selectors.EVENT_WRITE:
+        _flush(conn)
+    if mask & selectors.EVENT_READ:
+        st = conn_state.get(conn)
+        if st is None:
+            return
+        if st.state == HANDSHAKE:
+            _read_handshake(conn, st)
+        elif st.state == PENDING:
+            _read_pending(conn, st)
+        else:
+            _read_client(conn, st)
+
+def _read_handshake(conn, st):
     """
     Initial handshake for new connections:
-    Expect client to send: "NAME:<their name>" quickly.
+    Expect client to send: "NAME:<their name>\n".
     Then create a pending entry and wait for operator decision.
     """
-    global next_pending_id, pending, next_user_id, clients
+    global next_pending_id
     try:
-        conn.settimeout(500)  # short timeout for initial name----------------------------------------------------------------------
-        raw = conn.recv(2048)
-    except Exception:
-        try:
-            conn.close()
-        except:
-            pass
+        n = conn.recv_into(st.mv)
+    except BlockingIOError:
+        return
+    except OSError:
+        n = 0
+    if n == 0:
+        _close(conn)
+        return
+    st.inbuf += st.mv[:n]
+    if b"\n" not in st.inbuf:
+        if len(st.inbuf) > 2048:
+            _reject(conn)
         return
 
-    try:
-        s = raw.decode(errors='ignore').strip()
-    except:
-        s = ""
-
-    name = ""
-    if s.startswith("NAME:"):
-        name = s[5:].strip()
-    else:
+    line, _, _ = st.inbuf.partition(b"\n")
+    st.inbuf.clear()
+    s = line.decode(errors='ignore').strip()
+    if not s.startswith("NAME:"):
         # no proper handshake: close
-        try:
-            conn.sendall("REJECT".encode())
-        except:
-            pass
-        try:
-            conn.close()
-        except:
-            pass
+        _reject(conn)
         return
+    name = s[5:].strip()
 
     # create pending entry and wait for operator accept/reject
-    with pending_lock:
-        pid = next_pending_id
-        next_pending_id += 1
-        ev = threading.Event()
-        pending[pid] = {"conn": conn, "name": name, "addr": addr, "event": ev, "decision": None}
-    print(f"[PENDING {pid}] {name} from {addr}. Use 'accept {pid}' or 'reject {pid}'.")
-
-    # Wait until operator sets decision
-    ev.wait()
-    with pending_lock:
-        info = pending.pop(pid, None)
-    if not info:
-        try:
-            conn.close()
-        except:
-            pass
+    pid = next_pending_id
+    next_pending_id += 1
+    pending[pid] = {"conn": conn, "name": name, "addr": st.addr}
+    st.state = PENDING
+    st.name = name
+    st.pid = pid
+    print(f"[PENDING {pid}] {name} from {st.addr}. Use 'accept {pid}' or 'reject {pid}'.")
+
+def _read_pending(conn, st):
+    """A pending client should stay quiet; only watch for it hanging up."""
+    try:
+        n = conn.recv_into(st.mv)
+    except BlockingIOError:
         return
+    except OSError:
+        n = 0
+    if n == 0:
+        _drop_conn(conn)
 
-    decision = info["decision"]
-    if not decision:
-        # reject
-        try:
-            conn.sendall("REJECT".encode())
-        except:
+def _on_wakeup(sock, mask):
+    """The stdin thread posted command lines: drain the wakeup pipe and run them."""
+    try:
+        while sock.recv(4096):
             pass
+    except (BlockingIOError, OSError):
+        pass
+    while running:
         try:
-            conn.close()
-        except:
-            pass
-        print(f"[REJECTED] {name} from {addr}")
-        return
+            line = cli_lines.get_nowait()
+        except queue.Empty:
+            break
+        handle_cli(line)
 
-    # accept
-    with clients_lock:
-        user_id = next_user_id
-        next_user_id += 1
-        clients[conn] = {"id": user_id, "name": name, "addr": addr}
+def _accept_pending(conn):
+    """
+    Promote a pending connection to a client:
+    - In MESSAGING mode: announce the join and send a personal welcome
+    - In VOICE mode: send the current user list and announce the join
+    """
+    global next_user_id
+    st = conn_state.get(conn)
+    if st is None:
+        return
+    name = st.name
+    user_id = next_user_id
+    next_user_id += 1
+    st.id = user_id
+    st.state = ACCEPTED
+    _add_client(conn, st)
     # send mode token as acceptance
+    if not _send(conn, _MODE_BYTES):
+        _disconnect_conn(conn)
+        return
+
+    print(f"[ACCEPTED] {name} -> ID:{user_id} from {st.addr}. Total clients: {len(conns)}")
+
+    if MODE == "VOICE":
+        # Send the current list of users so client can show already-joined participants
+        _send(conn, _wire(_users_bytes))
+        broadcast_message(f"[Server]: {name} (ID:{user_id}) joined the call.", exclude_conn=conn)
+    else:  # MESSAGING
+        broadcast_message(f"[Server] User joined -> ID:{user_id}, Name:{name}", exclude_conn=conn)
+        # Send personal confirmation
+        _send(conn, _wire(f"Welcome {name}! Your ID is {user_id}"))
+
+def _read_client(conn, st):
+    """
+    For accepted clients:
+    - In MESSAGING mode: receive text messages and broadcast them (prefixed by name)
+    - In VOICE mode: receive audio chunks and broadcast to others.
+    """
     try:
-        conn.sendall(f"MODE:{MODE}".encode())
-    except:
+        n = conn.recv_into(st.mv)
+    except BlockingIOError:
+        return
+    except OSError:
+        n = 0
+    if n == 0:
+        _disconnect_conn(conn)
+        return
+    if MODE == "VOICE":
+        # Linux drops back to delayed ACKs on its own; re-arm so audio is ACKed at once
+        _set_opt(conn, socket.IPPROTO_TCP, "TCP_QUICKACK", 1)
+    # TCP is a stream: gather bytes until whole frames are in
+    inbuf = st.inbuf
+    inbuf += st.mv[:n]
+    end = 0         # bytes of inbuf consumed so far
+    run_start = 0   # start of the current run of consecutive audio frames
+    frames = 0      # audio frames in that run
+    with memoryview(inbuf) as mv:
+        while len(inbuf) - end >= HDR.size:
+            ftype, length = HDR.unpack_from(inbuf, end)
+            stop = end + HDR.size + length
+            if stop > len(inbuf):
+                break
+            if ftype == AUDIO_FRAME:
+                if MODE == "VOICE":
+                    frames += 1
+                end = stop
+                continue
+            # relay audio that arrived before this text frame, headers included
+            if frames:
+                _relay_audio(conn, st, mv[run_start:end], frames)
+                frames = 0
+                # a failed send to a peer can end up closing this sender too
+                if conn not in conn_state:
+                    return
+            payload = bytes(mv[end + HDR.size:stop])
+            end = run_start = stop
+            if ftype == TEXT_FRAME and not _handle_text(conn, st, payload):
+                return
+            if conn not in conn_state:
+                return
+        if frames:
+            _relay_audio(conn, st, mv[run_start:end], frames)
+            if conn not in conn_state:
+                return
+    del inbuf[:end]
+
+def _handle_text(conn, st, payload):
+    """
+    Internal: act on a TEXT frame from an accepted client.
+    - 'leave' disconnects the client (either mode)
+    - In MESSAGING mode anything else is broadcast, prefixed by name
+    Returns False once the client is gone.
+    """
+    # bytes.strip()/lower() run in C; no str is built just to spot the sentinel
+    if len(payload) < 64 and payload.strip().lower() == b"leave":
         _disconnect_conn(conn)
+        return False
+    if MODE == "VOICE":
+        return True
+    message = payload.decode(errors='ignore').strip()
+    if not message:
+        return True
+    full_msg = f"{st.name}: {message}"
+    print(full_msg)
+    broadcast_message(full_msg, exclude_conn=conn)
+    return True
+
+def _relay_audio(conn, st, frames, count):
+    """Internal: broadcast complete audio frames from conn, batching them when AUDIO_BATCH > 1."""
+    if AUDIO_BATCH == 1:
+        broadcast_audio(frames, count, exclude_conn=conn)
         return
+    if not st.audio_batch:
+        st.batch_deadline = time.monotonic() + AUDIO_BATCH_WAIT
+        batched_conns.add(conn)
+    st.audio_batch += frames
+    st.batch_frames += count
+    if st.batch_frames >= AUDIO_BATCH:
+        _flush_audio_batch(conn, st)
+
+def _flush_audio_batch(conn, st):
+    """Internal: relay a sender's accumulated audio frames in one broadcast."""
+    batched_conns.discard(conn)
+    with memoryview(st.audio_batch) as mv:
+        broadcast_audio(mv, st.batch_frames, exclude_conn=conn)
+    st.audio_batch.clear()
+    st.batch_frames = 0
+
+def _flush_stale_batches():
+    """Internal: don't let a partial batch wait longer than AUDIO_BATCH_WAIT."""
+    now = time.monotonic()
+    for conn in list(batched_conns):
+        st = conn_state.get(conn)
+        if st is None:
+            batched_conns.discard(conn)
+        elif st.batch_deadline <= now:
+            _flush_audio_batch(conn, st)
 
-    print(f"[ACCEPTED] {name} -> ID:{user_id} from {addr}. Total clients: {len(clients)}")
+def _expire_handshakes():
+    """Internal: close connections that never finished the NAME handshake."""
+    now = time.monotonic()
+    while handshake_deadlines and handshake_deadlines[0][0] <= now:
+        _, conn = handshake_deadlines.popleft()
+        st = conn_state.get(conn)
+        if st is not None and st.state == HANDSHAKE:
+            _close(conn)
 
-    # spawn handler for accepted connection
-    threading.Thread(target=handle_accepted_client, args=(conn, addr, user_id, name), daemon=True).start()
+def _select_timeout():
+    """Internal: how long select() may sleep before a batch or handshake deadline is due."""
+    now = time.monotonic()
+    timeout = None
+    if batched_conns:
+        first = min((conn_state[c].batch_deadline for c in batched_conns if c in conn_state),
+                    default=now)
+        timeout = max(first - now, 0.0)
+    if handshake_deadlines:
+        left = max(handshake_deadlines[0][0] - now, 0.0)
+        if timeout is None or left < timeout:
+            timeout = left
+    return timeout
 
-def accept_loop():
-    """Main accept loop — spawn a thread per incoming connection (handshake/pending)."""
+def reactor_loop():
+    """Main I/O loop — one thread dispatches accept, handshake, relay and write-ready events."""
+    sel.register(server_sock, selectors.EVENT_READ, _on_accept)
+    sel.register(wakeup_r, selectors.EVENT_READ, _on_wakeup)
+    _watch_stdin()
     while running:
         try:
-            conn, addr = server_sock.accept()
-            threading.Thread(target=handle_new_connection, args=(conn, addr), daemon=True).start()
-        except Exception:
+            events = sel.select(_select_timeout())
+        except OSError:
             break
+        for key, mask in events:
+            key.data(key.fileobj, mask)
+        if batched_conns:
+            _flush_stale_batches()
+        if handshake_deadlines:
+            _expire_handshakes()
 
-def operator_cli():
-    """Command-line for server operator to manage pending/clients."""
-    global running, MODE
-    help_text = (
-        "Commands:\n"
-        " pending                     -> show pending connection requests\n"
-        " accept <pid>                -> accept pending request\n"
-        " reject <pid>                -> reject pending request\n"
-        " list                        -> show connected clients\n"
-        " broadcast <message>         -> server send message to all\n"
-        " stop                        -> shutdown server\n"
-        " help                        -> show this\n"
-    )
-    print(help_text)
+HELP_TEXT = (
+    "Commands:\n"
+    " pending                     -> show pending connection requests\n"
+    " accept <pid>                -> accept pending request\n"
+    " reject <pid>                -> reject pending request\n"
+    " list                        -> show connected clients\n"
+    " broadcast <message>         -> server send message to all\n"
+    " stats                       -> show per-client send queue and dropped audio\n"
+    " stop                        -> shutdown server\n"
+    " help                        -> show this\n"
+)
+
+def handle_cli(cmd):
+    """Run one operator command. Called on the reactor thread, so it can touch clients/pending directly."""
+    global running
+    cmd = cmd.strip()
+    if not cmd:
+        return
+    parts = cmd.split(" ", 1)
+    action = parts[0].lower()
+    arg = parts[1].strip() if len(parts) > 1 else ""
+
+    if action == "pending":
+        if not pending:
+            print("No pending requests.")
+        else:
+            for pid, info in pending.items():
+                nm = info["name"]
+                addr = info["addr"]
+                print(f"PID:{pid} - {nm} from {addr}")
+    elif action == "accept":
+        if not arg:
+            print("Usage: accept <pid>")
+            return
+        try:
+            pid = int(arg)
+        except:
+            print("invalid pid")
+            return
+        info = pending.pop(pid, None)
+        if not info:
+            print("No such pending pid")
+        else:
+            print(f"Accepted pending {pid}")
+            _accept_pending(info["conn"])
+    elif action == "reject":
+        if not arg:
+            print("Usage: reject <pid>")
+            return
+        try:
+            pid = int(arg)
+        except:
+            print("invalid pid")
+            return
+        info = pending.pop(pid, None)
+        if not info:
+            print("No such pending pid")
+        else:
+            print(f"Rejected pending {pid}")
+            _reject(info["conn"])
+            print(f"[REJECTED] {info['name']} from {info['addr']}")
+    elif action == "list":
+        if not metas:
+            print("No connected clients.")
+        else:
+            for info in metas:
+                print(f"ID:{info.id} Name:{info.name} IP:{info.addr[0]} Port:{info.addr[1]}")
+    elif action == "stats":
+        if not metas:
+            print("No connected clients.")
+        else:
+            for info in metas:
+                print(f"ID:{info.id} Name:{info.name} Queued:{info.outbuf_bytes} bytes ({info.queued_frames} audio frames) Dropped frames:{info.dropped_frames}")
+    elif action == "kick":
+        if not arg:
+            print("Usage: kick <id>")
+            return
+        try:
+            uid = int(arg)
+        except:
+            print("invalid id")
+            return
+        target = None
+        for conn, info in zip(conns, metas):
+            if info.id == uid:
+                target = conn
+                break
+        if target is not None:
+            _try_send(target, KICK_NOTICE)
+            _disconnect_conn(target)
+            print(f"Kicked user {uid}")
+        else:
+            print("No such user id")
+    elif action == "broadcast":
+        if not arg:
+            print("Usage: broadcast <message>")
+            return
+        broadcast_message(f"[Server]: {arg}")
+        print("Broadcast sent.")
+    elif action == "stop":
+        print("Stopping server...")
+        running = False
+        # reject all pending
+        for pid, pinfo in list(pending.items()):
+            _reject(pinfo["conn"])
+        pending.clear()
+        # disconnect all clients
+        for conn in _clients_snapshot:
+            _try_send(conn, SHUTDOWN_NOTICE)
+            _close(conn)
+        conns.clear()
+        metas.clear()
+        conn_index.clear()
+        _rebuild_snapshot()
+        _rebuild_users()
+        _close(server_sock)
+    elif action == "help":
+        print(HELP_TEXT)
+    else:
+        print("Unknown command. Type 'help' for commands.")
+
+def _on_stdin(fileobj, mask):
+    """stdin is readable: run every complete operator command line."""
+    try:
+        data = os.read(fileobj.fileno(), MSG_RECV)
+    except OSError:
+        data = b""
+    if not data:
+        handle_cli("stop")
+        return
+    cli_buf.extend(data)
+    while running and b"\n" in cli_buf:
+        line, _, rest = cli_buf.partition(b"\n")
+        cli_buf[:] = rest
+        handle_cli(line.decode(errors='ignore'))
+
+def _stdin_thread():
+    """Fallback where stdin can't be selected: read lines here and hand them to the reactor."""
     while running:
         try:
-            cmd = input("").strip()
+            line = input("")
         except EOFError:
-            cmd = "stop"
-        if not cmd:
-            continue
-        parts = cmd.split(" ", 1)
-        action = parts[0].lower()
-        arg = parts[1].strip() if len(parts) > 1 else ""
-
-        if action == "pending":
-            with pending_lock:
-                if not pending:
-                    print("No pending requests.")
-                else:
-                    for pid, info in pending.items():
-                        nm = info["name"]
-                        addr = info["addr"]
-                        print(f"PID:{pid} - {nm} from {addr}")
-        elif action == "accept":
-            if not arg:
-                print("Usage: accept <pid>")
-                continue
-            try:
-                pid = int(arg)
-            except:
-                print("invalid pid")
-                continue
-            with pending_lock:
-                if pid not in pending:
-                    print("No such pending pid")
-                else:
-                    pending[pid]["decision"] = True
-                    pending[pid]["event"].set()
-                    print(f"Accepted pending {pid}")
-        elif action == "reject":
-            if not arg:
-                print("Usage: reject <pid>")
-                continue
-            try:
-                pid = int(arg)
-            except:
-                print("invalid pid")
-                continue
-            with pending_lock:
-                if pid not in pending:
-                    print("No such pending pid")
-                else:
-                    pending[pid]["decision"] = False
-                    pending[pid]["event"].set()
-                    print(f"Rejected pending {pid}")
-        elif action == "list":
-            with clients_lock:
-                if not clients:
-                    print("No connected clients.")
-                else:
-                    for c, info in clients.items():
-                        print(f"ID:{info['id']} Name:{info['name']} IP:{info['addr'][0]} Port:{info['addr'][1]}")
-        elif action == "kick":
-            if not arg:
-                print("Usage: kick <id>")
-                continue
-            try:
-                uid = int(arg)
-            except:
-                print("invalid id")
-                continue
-            kicked = False
-            with clients_lock:
-                for conn, info in list(clients.items()):
-                    if info["id"] == uid:
-                        try:
-                            conn.sendall("[Server]: You were kicked by admin.".encode())
-                        except:
-                            pass
-                        _disconnect_conn(conn)
-                        kicked = True
-                        break
-            if kicked:
-                print(f"Kicked user {uid}")
-            else:
-                print("No such user id")
-        elif action == "broadcast":
-            if not arg:
-                print("Usage: broadcast <message>")
-                continue
-            broadcast_message(f"[Server]: {arg}")
-            print("Broadcast sent.")
-        elif action == "stop":
-            print("Stopping server...")
-            running = False
-            # reject all pending
-            with pending_lock:
-                for pid, pinfo in list(pending.items()):
-                    try:
-                        pinfo["conn"].sendall("REJECT".encode())
-                    except:
-                        pass
-                    try:
-                        pinfo["conn"].close()
-                    except:
-                        pass
-                pending.clear()
-            # disconnect all clients
-            with clients_lock:
-                for conn in list(clients.keys()):
-                    try:
-                        conn.sendall("[Server]: Server shutting down.".encode())
-                    except:
-                        pass
-                    try:
-                        conn.close()
-                    except:
-                        pass
-                clients.clear()
-            try:
-                server_sock.close()
-            except:
-                pass
+            line = "stop"
+        cli_lines.put(line)
+        _wake()
+        if line.strip().lower() == "stop":
             break
-        elif action == "help":
-            print(help_text)
-        else:
-            print("Unknown command. Type 'help' for commands.")
+
+def _watch_stdin():
+    """Internal: feed operator commands to the reactor, via the selector where the OS allows it."""
+    if sys.platform != "win32":
+        try:
+            sel.register(sys.stdin, selectors.EVENT_READ, _on_stdin)
+            return
+        except (OSError, ValueError):
+            pass
+    threading.Thread(target=_stdin_thread, daemon=True).start()
+
+def _read_choice(prompt):
+    """
+    Internal: read the startup answer from stdin.
+    Where the reactor will read stdin with os.read, take one byte at a time so no
+    later command lines are pulled into Python's sys.stdin buffer, out of its reach.
+    """
+    if sys.platform == "win32":
+        return input(prompt)
+    print(prompt, end="", flush=True)
+    line = bytearray()
+    while True:
+        try:
+            b = os.read(sys.stdin.fileno(), 1)
+        except OSError:
+            break
+        if not b or b == b"\n":
+            break
+        line += b
+    return line.decode(errors='ignore')
 
 def main():
-    global MODE
+    global MODE, _MODE_BYTES
     print("Select server mode:\n1) Messaging (text chat)\n2) Voice (audio chat)")
-    choice = input("Enter 1 or 2: ").strip()
+    choice = _read_choice("Enter 1 or 2: ").strip()
     if choice == "1":
         MODE = "MESSAGING"
     elif choice == "2":
@@ -406,9 +908,10 @@ def main():
         print("Invalid choice. Exiting.")
         return
 
+    _MODE_BYTES = f"MODE:{MODE}\n".encode()
     print(f"Server mode set to: {MODE}. Listening on {HOST}:{PORT}")
-    threading.Thread(target=accept_loop, daemon=True).start()
-    operator_cli()
+    print(HELP_TEXT)
+    reactor_loop()
     print("Server terminated.")
 
 if __name__ == "__main__":
@@ -14,18 +14,41 @@ In voice: type 'leave' to exit; audio will stream both ways.
 """
 
 import socket
+import struct
 import threading
-import time
 import sys
 
 SERVER_IP = input("Enter server IP: ").strip()
 SERVER_PORT = 50007
 NAME = input("Enter your name: ").strip()
 
-CHUNK = 2048
+CHUNK = 1920  # 40 ms at 48 kHz; Opus only takes 2.5/5/10/20/40/60 ms frames
 RATE = 48000
 CHANNELS = 1
 
+# Voice audio is Opus-encoded before it goes on the wire (~30x smaller than raw int16)
+OPUS_BITRATE = 24000
+
+# After the handshake every message in either direction is a frame:
+# 1-byte type + 2-byte big-endian length + payload
+HDR = struct.Struct('!BH')
+AUDIO_FRAME = 0
+TEXT_FRAME = 1
+MAX_FRAME = 0xFFFF
+
+# Voice sockets: bigger kernel buffers absorb broadcast bursts
+SOCK_BUF = 262144
+
+# recv_frame reuses this buffer for every recv_into instead of allocating per frame
+recv_buf = bytearray(MAX_FRAME)
+recv_view = memoryview(recv_buf)
+
+# sender threads share the socket; frames must not interleave
+send_lock = threading.Lock()
+
+# voice mode: set when the call ends so the main thread can exit
+stop_event = threading.Event()
+
 client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 try:
     client_sock.connect((SERVER_IP, SERVER_PORT))
@@ -33,9 +56,19 @@ except Exception as e:
     print("Could not connect to server:", e)
     sys.exit(1)
 
+def recv_line(sock):
+    """Read one newline-terminated handshake line, leaving anything after it in the socket."""
+    buf = bytearray()
+    while True:
+        b = sock.recv(1)
+        if not b or b == b"\n":
+            break
+        buf += b
+    return buf.decode(errors='ignore').strip()
+
 # send handshake name
 try:
-    client_sock.sendall(f"NAME:{NAME}".encode())
+    client_sock.sendall(f"NAME:{NAME}\n".encode())
 except Exception as e:
     print("Failed to send name:", e)
     client_sock.close()
@@ -43,7 +76,7 @@ except Exception as e:
 
 # wait for server response
 try:
-    response = client_sock.recv(4096).decode(errors='ignore').strip()
+    response = recv_line(client_sock)
 except Exception:
     print("No response from server.")
     client_sock.close()
@@ -63,18 +96,46 @@ else:
     sys.exit(1)
 
 
+# ----------------- Framing -----------------
+def send_frame(sock, ftype, payload):
+    """Send one frame."""
+    with send_lock:
+        sock.sendall(HDR.pack(ftype, len(payload)) + payload)
+
+def recv_exact(sock, view, n):
+    """Fill view[:n] from the socket. Returns False if the connection closed first."""
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:n])
+        if k == 0:
+            return False
+        got += k
+    return True
+
+def recv_frame(sock):
+    """
+    Read one frame. Returns (type, payload) or None once the server hangs up.
+    payload is a view into recv_buf, valid until the next call.
+    """
+    if not recv_exact(sock, recv_view, HDR.size):
+        return None
+    ftype, length = HDR.unpack_from(recv_buf)
+    if not recv_exact(sock, recv_view, length):
+        return None
+    return ftype, recv_view[:length]
+
+
 # ----------------- Messaging mode -----------------
 def messaging_receive(sock):
     while True:
         try:
-            data = sock.recv(4096)
-            # if not data:
-            #     print("Disconnected from server.")
-            #     break
-            if not data:
-                continue
-            else:
-                text = data.decode(errors='ignore')
+            frame = recv_frame(sock)
+            if frame is None:
+                print("Disconnected from server.")
+                break
+            ftype, data = frame
+            if ftype == TEXT_FRAME:
+                text = str(data, "utf-8", errors='ignore')
                 print("\n" + text)
         except Exception as e:
             print("Connection lost:", e)
@@ -92,7 +153,7 @@ def messaging_send(sock):
             msg = input("")
             if not msg:
                 continue
-            sock.sendall(msg.encode())
+            send_frame(sock, TEXT_FRAME, msg.encode()[:MAX_FRAME])
             if msg.lower() == "leave":
                 print("You left the chat.")
                 break
@@ -107,42 +168,40 @@ def messaging_send(sock):
 
 
 # ----------------- Voice mode -----------------
-def voice_receive(sock, stream_out):
+def voice_receive(sock, stream_out, dec):
     """
-    In voice mode we may also receive short textual notifications (server notices or user lists).
-    We attempt to decode incoming bytes and if it starts with markers treat as text, else treat as audio.
+    In voice mode we also receive textual notifications (server notices or user lists)
+    as TEXT frames; AUDIO frames carry Opus packets to decode and play.
     """
     while True:
         try:
-            data = sock.recv(CHUNK)
-            if not data:
+            frame = recv_frame(sock)
+            if frame is None:
                 break
-            # try to decode small control messages
-            if len(data) < 512:
-                try:
-                    s = data.decode(errors='ignore').strip()
-                    if s.startswith("[USERS]"):
-                        users = s[len("[USERS]"):].strip()
-                        print(f"\n[Users currently in call] {users}")
-                        continue
-                    if s.startswith("[Server]") or s.startswith("[SERVER]") or s.startswith("[Server]:"):
-                        print("\n" + s)
-                        continue
-                except Exception:
-                    pass
-            # otherwise treat as audio
+            ftype, data = frame
+            if ftype == TEXT_FRAME:
+                s = str(data, "utf-8", errors='ignore').strip()
+                if s.startswith("[USERS]"):
+                    users = s[len("[USERS]"):].strip()
+                    print(f"\n[Users currently in call] {users}")
+                else:
+                    print("\n" + s)
+                continue
+            if ftype != AUDIO_FRAME or not data:
+                continue
             try:
-                stream_out.write(data)
+                stream_out.write(dec.decode(bytes(data), CHUNK))
             except Exception:
                 pass
         except Exception:
             break
+    stop_event.set()
 
-def voice_send(sock, stream_in):
+def voice_send(sock, stream_in, enc):
     while True:
         try:
             data = stream_in.read(CHUNK, exception_on_overflow=False)
-            sock.sendall(data)
+            send_frame(sock, AUDIO_FRAME, enc.encode(data, CHUNK))
         except Exception:
             break
 
@@ -151,7 +210,7 @@ def voice_user_input(sock):
         cmd = input("")
         if cmd.lower() == "leave":
             try:
-                sock.sendall("leave".encode())
+                send_frame(sock, TEXT_FRAME, b"leave")
             except:
                 pass
             try:
@@ -159,7 +218,8 @@ def voice_user_input(sock):
             except:
                 pass
             print("You left the voice call.")
-            sys.exit(0)
+            stop_event.set()
+            return
 
 
 def start_voice_mode(sock):
@@ -170,6 +230,18 @@ def start_voice_mode(sock):
         print("PyAudio not installed. Install with: pip install pyaudio")
         sock.close()
         sys.exit(1)
+    # ensure opuslib present
+    try:
+        import opuslib
+    except Exception:
+        print("opuslib not installed. Install with: pip install opuslib")
+        sock.close()
+        sys.exit(1)
+
+    # audio chunks are small and latency sensitive: no Nagle coalescing
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUF)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUF)
 
     pa = pyaudio.PyAudio()
     stream_in = pa.open(format=pyaudio.paInt16,
@@ -183,23 +255,29 @@ def start_voice_mode(sock):
                          output=True,
                          frames_per_buffer=CHUNK)
 
+    enc = opuslib.Encoder(RATE, CHANNELS, 'voip')
+    enc.bitrate = OPUS_BITRATE
+    dec = opuslib.Decoder(RATE, CHANNELS)
+
     print("Joined voice call. Type 'leave' to exit.")
 
-    threading.Thread(target=voice_receive, args=(sock, stream_out), daemon=True).start()
-    threading.Thread(target=voice_send, args=(sock, stream_in), daemon=True).start()
+    threading.Thread(target=voice_receive, args=(sock, stream_out, dec), daemon=True).start()
+    threading.Thread(target=voice_send, args=(sock, stream_in, enc), daemon=True).start()
     threading.Thread(target=voice_user_input, args=(sock,), daemon=True).start()
 
-    # keep main thread alive
+    # keep main thread alive until the call ends
     try:
-        while True:
-            time.sleep(0.1)
+        stop_event.wait()
     except KeyboardInterrupt:
         try:
-            sock.sendall("leave".encode())
+            send_frame(sock, TEXT_FRAME, b"leave")
         except:
             pass
+    try:
         sock.close()
-        sys.exit(0)
+    except:
+        pass
+    sys.exit(0)
 
 
 # ----------------- Mode dispatch -----------------